@@ -1,9 +1,30 @@
 import lazyllm
 from lazyllm import pipeline, warp, bind, parallel
 from lazyllm.components.formatter import JsonFormatter
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime
+import functools
+import hashlib
 import os
 import json
 import logging
+import random
+import re
+import threading
+import time
+
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 
 logging.basicConfig(
@@ -109,6 +130,8 @@ Example output:
 
 Requirements:
 - Create 25-30 chapters with logical progression
+- If the input specifies a chapter range, output only the chapters in that range, numbered accordingly and continuing naturally from the chapters already designed
+- If the chapters already designed end before the requested range, the chapters in between are being designed separately; keep the plot consistent with the overall arc rather than repeating their events
 - Ensure each chapter advances the plot meaningfully
 - Balance action, character development, and world-building
 - Maintain proper pacing throughout the narrative
@@ -225,137 +248,676 @@ Quality standards:
 Please provide the COMPLETE final polished version of the chapter content. Do not provide summaries or excerpts.
 """
 
+fused_chapter_prompt = """
+You are now an accomplished novelist who also acts as your own quality reviewer and final editor. Your task is to deliver the final, publication-ready chapter in a single pass, based on the provided chapter outline and story context.
+
+While writing, hold yourself to the review criteria:
+1. Adherence to the chapter outline
+2. Character consistency with the story setting
+3. Plot coherence and continuity with the previous chapters
+4. Language fluency and literary quality
+
+Polish as you write:
+- Refine word choice and sentence structure, strengthen dialogue and character voices
+- Smooth transitions between scenes and paragraphs, enhance emotional impact
+- Ensure consistent tone and style throughout the chapter
+
+Requirements:
+- 2,000-3,000 words in Chinese, vivid and immersive, advancing the plot according to the outline
+- Output only the final chapter content, without title, review notes or formatting markers
+"""
+
+chapter_summary_prompt = """
+You are now a story continuity assistant. Your task is to maintain a running summary of the story so far, so that later chapters can be checked for consistency without re-reading the full text.
+
+You will receive the existing story summary and the newly completed chapter. Fold the new chapter into the summary.
+
+Requirements:
+- Write the updated summary in Chinese, within 300 characters in total
+- Keep key plot events, changes in character state, and unresolved foreshadowing; compress older events more than recent ones
+- Output the summary text only, without title or formatting markers
+"""
+
+# 分段设计大纲时发送给大纲设计师的用户输入模板
+outline_request_template = """
+故事设定：{setting}
+
+全书共{total}章，本次只设计第{start}章到第{end}章的大纲。
+
+已完成的章节大纲：
+{prior}
+"""
+
+# 每章发送给写作/审查Agent的用户输入模板，系统prompt已在创建Agent时绑定，
+# 每次调用只需填入本章的变量部分；各章相同的故事设定放在最前面，
+# 使请求前缀在各章之间保持一致，可以命中服务端的前缀缓存
+writing_template = """
+故事背景：{setting}
+
+全书目录：{digest}
+
+章节大纲：{outline}
+
+本章人物：{characters}
+
+前情提要：
+{prior}
+
+请根据以上信息创作本章内容。
+"""
+
+review_template = """
+故事设定：{setting}
+章节大纲：{outline}
+本章人物：{characters}
+前文内容：{previous}
+
+章节内容：
+{content}
+"""
+
+# 合并模式下章节篇幅不足时，附在原输入后重新创作一次
+expand_template = """{prompt}
+
+上一次创作的篇幅不足{min_words}字。请重新完整创作本章，正文不少于{min_words}字。
+"""
+
+# 润色结果篇幅被大幅删减时，带着更明确的要求重新润色一次
+keep_length_template = """
+上一次润色删减了大量内容。请重新润色以下章节：只调整语言表达，完整保留所有情节、对话和细节，不得缩写或删减，润色后的篇幅不少于原文。
+
+{content}
+"""
+
+# 滚动摘要：把新完成的章节并入已有的故事摘要
+rolling_summary_template = """
+已有的故事摘要：
+{summary}
+
+新完成的章节：
+{chapter}
+"""
+
+# ==================== Serialization ====================
+
+def to_json(obj):
+    """序列化为保留中文字符的JSON字符串，安装了orjson时使用orjson"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False)
+
+def from_json(text):
+    """解析JSON字符串，安装了orjson时使用orjson"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+# ==================== Output Validation ====================
+
+def _parse_json_text(result):
+    """JsonFormatter未能解析时会返回原始文本，截取其中的JSON部分在本地再解析一次"""
+    if not isinstance(result, str):
+        return result
+    match = re.search(r'[\[{].*[\]}]', result, re.S)
+    if match:
+        try:
+            return from_json(match.group())
+        except ValueError:
+            pass
+    return None
+
+def parse_story_setting(result):
+    """校验故事设定，格式无效时返回None"""
+    setting = _parse_json_text(result)
+    if not isinstance(setting, dict):
+        logging.warning("故事设定格式无效")
+        return None
+    characters = setting.get('main_characters')
+    return dict(setting, main_characters=[
+        char for char in (characters if isinstance(characters, list) else [])
+        if isinstance(char, dict) and char.get('name')
+    ])
+
+# 章节大纲对象特有的字段，用于区分单个章节和包着章节列表的对象
+_CHAPTER_KEYS = ('chapter_number', 'title', 'summary')
+
+def parse_outline_chunk(result):
+    """校验一段章节大纲，只保留有效的章节对象"""
+    chunk = _parse_json_text(result)
+    if isinstance(chunk, dict):
+        # 只有一章时模型可能直接返回章节对象；也可能把章节列表包在一个对象里返回。
+        # 章节对象本身也有列表字段（key_events），因此只展开元素为对象的列表
+        wrapped = None
+        if not any(key in chunk for key in _CHAPTER_KEYS):
+            wrapped = next((
+                v for v in chunk.values() if isinstance(v, list) and v and all(isinstance(c, dict) for c in v)
+            ), None)
+        chunk = wrapped if wrapped is not None else [chunk]
+    if not isinstance(chunk, list):
+        logging.warning("章节大纲格式无效，本段大纲为空")
+        return []
+    return [chapter for chapter in chunk if isinstance(chapter, dict)]
+
+def parse_review(result):
+    """校验审查结果，统一approved、quality_score和revised_content的类型"""
+    review = _parse_json_text(result)
+    if not isinstance(review, dict):
+        logging.warning("审查结果格式无效，按未通过处理")
+        review = {}
+    approved = review.get('approved', False)
+    if isinstance(approved, str):
+        approved = approved.strip().lower() in ('true', 'yes', '1', '通过')
+    # 评分可能是数字，也可能是"8"、"8/10"这样的字符串
+    match = re.search(r'\d+(?:\.\d+)?', str(review.get('quality_score', '')))
+    revised_content = review.get('revised_content')
+    return dict(
+        review,
+        approved=bool(approved),
+        quality_score=float(match.group()) if match else 0.0,
+        revised_content=revised_content if isinstance(revised_content, str) else '',
+    )
+
 # ==================== Context Management ====================
 
 class NovelContext:
+    # 固定属性集合，省去实例字典，主流程中频繁读取的字数、进度等属性访问更快
+    __slots__ = (
+        'story_setting', 'story_setting_json', 'chapter_setting_json', 'characters', 'outline', 'recent_chapters',
+        'recent_chapter_tokens', 'story_summaries', 'current_chapter', 'total_words', 'total_tokens',
+    )
+
     def __init__(self):
         self.story_setting = {}
+        # 故事设定序列化后的JSON，设定更新时生成一次，供每章的prompt直接复用
+        self.story_setting_json = "{}"
+        # 章节prompt使用的设定不含人物列表，各章只附上本章涉及的人物
+        self.chapter_setting_json = "{}"
         self.characters = {}
         self.outline = []
-        self.written_chapters = []
+        # 只保留最近3章作为上下文窗口，完整小说由主流程单独组装
+        self.recent_chapters = deque(maxlen=3)
+        # 与recent_chapters一一对应的token数，入库时统计一次，组装上下文时无需重复分词
+        self.recent_chapter_tokens = deque(maxlen=3)
+        # 每章完成后的滚动摘要（Future），覆盖从第一章到该章的全部内容，
+        # 原文窗口之外的章节只以一段长度固定的摘要进入上下文
+        self.story_summaries = []
         self.current_chapter = 0
         self.total_words = 0
+        self.total_tokens = 0
         
     def update_setting(self, setting):
         self.story_setting = setting
+        self.story_setting_json = to_json(setting)
+        self.chapter_setting_json = to_json({k: v for k, v in setting.items() if k != 'main_characters'})
         self.characters = {char['name']: char for char in setting.get('main_characters', [])}
+
+    def characters_json_for(self, chapter_outline_json):
+        """本章大纲中提到的人物，大纲未提到任何主要人物时返回全部主要人物"""
+        relevant = [char for name, char in self.characters.items() if name in chapter_outline_json]
+        return to_json(relevant or list(self.characters.values()))
         
     def update_outline(self, outline):
         self.outline = outline
         
-    def add_chapter(self, chapter_content):
-        self.written_chapters.append(chapter_content)
-        self.total_words += len(chapter_content)
+    def add_chapter(self, chapter_content, word_count):
+        # 字数由调用方统计好传入，避免对同一章重复统计
+        tokens = count_tokens(chapter_content)
+        self.recent_chapters.append(chapter_content)
+        self.recent_chapter_tokens.append(tokens)
+        self.total_words += word_count
+        self.total_tokens += tokens
         self.current_chapter += 1
         
     def get_context_for_chapter(self, chapter_num):
         # 获取前3章内容作为上下文
-        recent_chapters = self.written_chapters[-3:] if self.written_chapters else []
         context = {
             'story_setting': self.story_setting,
+            'story_setting_json': self.story_setting_json,
+            'chapter_setting_json': self.chapter_setting_json,
             'characters': self.characters,
-            'recent_chapters': recent_chapters,
+            'recent_chapters': list(self.recent_chapters),
+            'recent_chapter_tokens': list(self.recent_chapter_tokens),
+            'story_summaries': self.story_summaries,
             'current_chapter_outline': self.outline[chapter_num] if chapter_num < len(self.outline) else {},
             'total_words': self.total_words,
             'progress': f"{chapter_num + 1}/{len(self.outline)}"
         }
         return context
 
+@functools.lru_cache(maxsize=1)
+def _get_token_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model("gpt-4")
+    except Exception as e:
+        # 首次使用需要下载词表，离线环境下退化为按字符估算
+        logging.warning(f"加载tiktoken词表失败，按字符数估算token: {e}")
+        return None
+
+def count_tokens(text):
+    """统计文本的token数，tiktoken不可用时按字符数估算"""
+    encoding = _get_token_encoding()
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text))
+
+def truncate_to_tokens(text, max_tokens):
+    """保留文本末尾不超过max_tokens个token的部分，tiktoken不可用时按字符数截取"""
+    encoding = _get_token_encoding()
+    if encoding is None:
+        return text[-max_tokens:] if max_tokens > 0 else ""
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[-max_tokens:]) if max_tokens > 0 else ""
+
+class ContextBudget:
+    """按token预算组装前文：最近几章保留原文，更早的章节合并为一段滚动摘要"""
+
+    def __init__(self, max_tokens=4000, keep_recent=2):
+        self.max_tokens = max_tokens
+        self.keep_recent = keep_recent
+
+    def build(self, recent_chapters, recent_tokens, story_summaries):
+        # 按起始下标截取，keep_recent为0时不保留原文（[-0:]会取到全部）
+        skip = max(0, len(recent_chapters) - self.keep_recent)
+        recent = list(recent_chapters)[skip:]
+        recent_tokens = list(recent_tokens)[skip:]
+        parts, used = [], 0
+        # 从最近一章往前填充原文；放不下或超出原文窗口时，
+        # 用覆盖到该章为止的滚动摘要代替其余全部前文
+        for age in range(len(story_summaries)):
+            text = recent[-1 - age] if age < len(recent) else None
+            tokens = recent_tokens[-1 - age] if text is not None else 0
+            if age == 0 and text is not None and tokens > self.max_tokens:
+                # 最近一章本身就超出预算时，按token精确保留其结尾，衔接处最重要
+                text = truncate_to_tokens(text, self.max_tokens)
+                tokens = self.max_tokens
+            elif text is None or used + tokens > self.max_tokens:
+                text = f"（前情摘要）{story_summaries[-1 - age].result()}"
+                if used + count_tokens(text) <= self.max_tokens:
+                    parts.append(text)
+                break
+            parts.append(text)
+            used += tokens
+        return "\n\n".join(reversed(parts)) if parts else "无"
+
+def chapter_target_words(chapter_outline, default=2500):
+    """解析章节大纲中的目标字数，格式与目标章节数一样不固定"""
+    match = re.search(r'\d+', str(chapter_outline.get('target_words', '')))
+    return int(match.group()) if match else default
+
+# 目标章节数的合理范围，超出时视为模型输出有误，使用默认值
+MAX_TARGET_CHAPTERS = 60
+
+def target_chapter_count(story_setting, default=28):
+    """解析故事设定中的目标章节数，模型可能给出数字，也可能给出"25-30"这样的范围"""
+    match = re.search(r'\d+', str(story_setting.get('target_chapters', '')))
+    count = int(match.group()) if match else default
+    if not 1 <= count <= MAX_TARGET_CHAPTERS:
+        logging.warning(f"目标章节数{count}超出1-{MAX_TARGET_CHAPTERS}章，使用默认的{default}章")
+        return default
+    return count
+
 # ==================== Quality Control ====================
 
+# 统计字数时需要去除的空白字符：全部Unicode空白（含全角空格、不间断空格），
+# 以及模型输出中偶尔夹带的零宽字符
+_WS_RE = re.compile(r'[\s\u200b-\u200d\ufeff]+')
+
 def check_word_count(content):
     """改进的字数统计 - 更准确地统计中文字数"""
-    # 移除空白字符后统计长度，对中文更准确
-    cleaned_content = content.replace(' ', '').replace('\n', '').replace('\t', '')
-    return len(cleaned_content)
-
-def save_novel_to_cache(novel_content, story_theme, total_words, total_chapters):
-    """保存完整小说到本地cache目录"""
-    import os
-    from datetime import datetime
-    
-    # 创建cache目录
+    # 正则在C层一次扫描出所有空白段，总长度减去空白长度，对中文更准确
+    return len(content) - sum(len(ws) for ws in _WS_RE.findall(content))
+
+# 小说文件的追加写入在后台线程中完成，不阻塞创作主流程；单线程保证各章按提交顺序落盘
+_save_executor = lazyllm.ThreadPoolExecutor(max_workers=1)
+
+def _append_file(filepath, text):
+    try:
+        # 以二进制一次写入编码后的内容，省去文本模式的转换
+        with open(filepath, 'ab') as f:
+            f.write(text.encode('utf-8'))
+        return True
+    except Exception as e:
+        logging.error(f"保存小说失败: {e}")
+        return False
+
+# 有章节写入失败的小说文件，只在保存线程中修改
+_failed_novel_files = set()
+
+def _append_novel(filepath, text):
+    if not _append_file(filepath, text):
+        _failed_novel_files.add(filepath)
+
+# 文件名中只保留字母数字（含中文）、空格、连字符和下划线
+_UNSAFE_FILENAME_CHARS = re.compile(r'[^\w \-]')
+
+def create_novel_cache(story_theme):
+    """在本地cache目录创建小说文件并写入标题，返回文件路径，失败时返回None"""
     cache_dir = "cache"
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
     
-    # 生成文件名
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    safe_theme = "".join(c for c in story_theme if c.isalnum() or c in (' ', '-', '_')).rstrip()[:20]
+    # 生成文件名，文件名与正文中的创作时间使用同一时刻
+    now = datetime.now()
+    timestamp = now.strftime("%Y%m%d_%H%M%S")
+    safe_theme = _UNSAFE_FILENAME_CHARS.sub('', story_theme).rstrip()[:20]
     filename = f"novel_{safe_theme}_{timestamp}.md"
     filepath = os.path.join(cache_dir, filename)
     
-    # 准备markdown内容
-    markdown_content = f"""# {story_theme}
-
-**创作时间**: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}  
-**总字数**: {total_words:,} 字  
-**章节数**: {total_chapters} 章  
+    header = f"""# {story_theme}
 
----
-
-{novel_content}
+**创作时间**: {now.strftime("%Y-%m-%d %H:%M:%S")}  
 
 ---
 
-*本小说由 LazyLLM Multi-Agent 系统创作*
 """
-    
-    # 保存文件
     try:
+        # exist_ok避免并发请求之间先检查后创建的竞争
+        os.makedirs(cache_dir, exist_ok=True)
         with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(markdown_content)
-        logging.info(f"完整小说已保存到: {filepath}")
+            f.write(header)
         return filepath
     except Exception as e:
-        logging.error(f"保存小说失败: {e}")
+        logging.error(f"创建小说文件失败: {e}")
+        return None
+
+def append_novel_cache(filepath, text):
+    """向小说文件追加内容，每章完成后立即提交后台写入，中途失败也能保留已完成的章节"""
+    if filepath is None:
         return None
+    _save_executor.submit(_append_novel, filepath, text)
+    return filepath
+
+def finish_novel_cache(filepath, total_words, total_chapters):
+    """在小说文件末尾写入统计信息"""
+    footer = f"""---
+
+**总字数**: {total_words:,} 字  
+**章节数**: {total_chapters} 章  
+
+*本小说由 LazyLLM Multi-Agent 系统创作*
+"""
+    if filepath is None:
+        return None
+    # 等待此前提交的各章和结尾写入完成，返回给用户时文件已完整；
+    # 保存线程按提交顺序执行，结尾写入完成时各章的写入结果都已记录
+    _save_executor.submit(_append_novel, filepath, footer).result()
+    if filepath in _failed_novel_files:
+        _failed_novel_files.discard(filepath)
+        logging.error(f"小说文件部分内容写入失败，文件不完整: {filepath}")
+        return None
+    logging.info(f"完整小说已保存到: {filepath}")
+    return filepath
 
 def log_progress(stage, message, context=None):
-    log_msg = f"{stage}: {message}"
+    # 交给logging按需格式化，日志级别高于INFO时不拼接字符串
     if context:
-        log_msg += (
-            f" | 当前字数: {context.total_words}"
-            f" | 进度: {context.current_chapter}/{len(context.outline)}"
+        logging.info(
+            "%s: %s | 当前字数: %s | 进度: %s/%s",
+            stage, message, context.total_words, context.current_chapter, len(context.outline)
+        )
+    else:
+        logging.info("%s: %s", stage, message)
+
+# ==================== Agent Calls ====================
+
+# 单次Agent调用遇到限流或网络错误时的最大尝试次数，至少调用一次
+MAX_RETRIES = max(1, int(os.getenv("NOVEL_MAX_RETRIES", "6")))
+
+# 错误内容中出现这些标记时说明请求本身有误（密钥无效、上下文过长等），重试也不会成功
+_NON_TRANSIENT_ERRORS = (
+    'invalid_api_key', 'invalid_request_error', 'authentication_error', 'permission_error',
+    'context_length_exceeded', 'insufficient_quota', 'model_not_found',
+)
+
+def _is_transient(error):
+    """判断请求异常是否值得重试：限流、超时、服务端错误和网络异常重试，其余4xx错误直接抛出"""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    # 在线模型模块把错误响应的内容放在异常信息中，没有附带响应对象
+    text = str(error)
+    return not any(marker in text for marker in _NON_TRANSIENT_ERRORS)
+
+def call_agent(agent, *args):
+    """调用Agent，遇到限流(429)、服务端错误或网络异常时按指数退避加随机抖动重试"""
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            return agent(*args)
+        except requests.RequestException as e:
+            if attempt == MAX_RETRIES or not _is_transient(e):
+                raise
+            delay = random.uniform(1, min(60, 2 ** attempt))
+            logging.warning(f"Agent调用失败({attempt}/{MAX_RETRIES})，{delay:.1f}秒后重试: {e}")
+            time.sleep(delay)
+
+# 是否缓存结果可复用的Agent调用，以及磁盘缓存目录
+LLM_CACHE = os.getenv("NOVEL_LLM_CACHE", "1") == "1"
+LLM_CACHE_DIR = os.path.join("cache", "llm")
+
+# 进程内缓存的最大条目数
+LLM_MEMORY_CACHE_SIZE = 256
+
+def cached_agent(agent, *namespace, parse=None):
+    """为结果可复用的Agent加上缓存：进程内缓存在前，磁盘缓存在后，重复的输入可以跨运行直接命中。
+
+    parse在写入缓存之前校验并转换回复，返回空值（或未通过调用方check）的结果视为无效，
+    不写入缓存，下次调用会重新请求。
+    """
+    prefix = "\0".join(namespace)
+    memory = {}
+    lock = threading.Lock()
+
+    def call(prompt, check=None):
+        def valid(result):
+            return bool(result) and (check is None or check(result))
+
+        if LLM_CACHE:
+            with lock:
+                result = memory.get(prompt)
+            if result is not None and valid(result):
+                return result
+            key = hashlib.blake2b(f"{prefix}\0{prompt}".encode('utf-8'), digest_size=16).hexdigest()
+            path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+            if os.path.exists(path):
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        result = from_json(f.read())
+                    result = parse(result) if parse else result
+                    if valid(result):
+                        with lock:
+                            memory[prompt] = result
+                        return result
+                except (OSError, ValueError) as e:
+                    logging.warning(f"读取LLM缓存失败，重新调用: {e}")
+
+        result = agent(prompt)
+        result = parse(result) if parse else result
+        if LLM_CACHE and valid(result):
+            with lock:
+                if len(memory) >= LLM_MEMORY_CACHE_SIZE:
+                    memory.pop(next(iter(memory)))
+                memory[prompt] = result
+            try:
+                os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(to_json(result))
+            except OSError as e:
+                logging.warning(f"写入LLM缓存失败: {e}")
+        return result
+
+    return call
+
+# ==================== Batch API ====================
+
+def run_chat_batch(base_url, api_key, system_prompt, user_prompts, model="gpt-4", poll_interval=30):
+    """通过OpenAI Batch API批量提交对话请求，按输入顺序返回回复，失败的请求对应位置为None"""
+    api_base = base_url.rstrip('/')
+    lines = [
+        to_json({
+            "custom_id": f"req-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": prompt},
+                ],
+            },
+        })
+        for i, prompt in enumerate(user_prompts)
+    ]
+
+    # 上传、轮询、下载共用一个会话，复用同一条keep-alive连接，不必每次请求重新握手
+    with requests.Session() as session:
+        session.headers.update({"Authorization": f"Bearer {api_key}"})
+        # 上传请求文件并创建批量任务
+        resp = session.post(
+            f"{api_base}/files", data={"purpose": "batch"},
+            files={"file": ("batch.jsonl", "\n".join(lines).encode('utf-8'))}
         )
-    logging.info(log_msg)
-    return log_msg
+        resp.raise_for_status()
+        resp = session.post(f"{api_base}/batches", json={
+            "input_file_id": resp.json()["id"],
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h",
+        })
+        resp.raise_for_status()
+        batch = resp.json()
+
+        def fetch(url):
+            resp = session.get(url)
+            resp.raise_for_status()
+            return resp
+
+        finished = ("completed", "failed", "expired", "cancelled")
+        try:
+            # 轮询直到任务结束；轮询和下载遇到临时错误时与Agent调用一样退避重试，
+            # 不因一次5xx放弃仍在运行（并计费）的任务
+            while batch["status"] not in finished:
+                time.sleep(poll_interval)
+                batch = call_agent(fetch, f"{api_base}/batches/{batch['id']}").json()
+                logging.info(f"Batch任务 {batch['id']} 状态: {batch['status']}")
+            if batch["status"] != "completed":
+                raise RuntimeError(f"Batch任务 {batch['id']} 未完成，状态: {batch['status']}")
+
+            # 下载结果，按custom_id还原顺序
+            resp = call_agent(fetch, f"{api_base}/files/{batch['output_file_id']}/content")
+        except Exception:
+            # 放弃等待时取消仍在运行的任务，避免改为实时调用后继续为其计费
+            if batch["status"] not in finished:
+                try:
+                    session.post(f"{api_base}/batches/{batch['id']}/cancel").raise_for_status()
+                    logging.warning(f"已取消Batch任务 {batch['id']}")
+                except requests.RequestException as e:
+                    logging.error(f"取消Batch任务 {batch['id']} 失败: {e}")
+            raise
+
+    replies = {}
+    for line in resp.text.splitlines():
+        if not line.strip():
+            continue
+        item = from_json(line)
+        response = item.get("response") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            logging.warning(f"Batch请求 {item.get('custom_id')} 失败: {item.get('error')}")
+            continue
+        replies[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return [replies.get(f"req-{i}") for i in range(len(user_prompts))]
 
 # ==================== Main Pipeline ====================
 
+# 在线模型接口配置，在导入时读取一次
+BASE_URL = os.getenv("LAZYLLM_BASE_URL", "https://www.dmxapi.com/v1/")
+API_KEY = os.getenv("LAZYLLM_OPENAI_API_KEY", "")
+
+# 全书目标字数，达到后停止创作
+TARGET_WORDS = int(os.getenv("NOVEL_TARGET_WORDS", "50000"))
+# 各Agent默认使用的模型
+MODEL = os.getenv("NOVEL_MODEL", "gpt-4")
+# 质量审查只做结构化评分，使用更快、更便宜的模型
+REVIEW_MODEL = os.getenv("NOVEL_REVIEW_MODEL", "gpt-4o-mini")
+# 润色只调整语言表达，不需要写作模型的创造力，同样使用低成本模型
+EDITOR_MODEL = os.getenv("NOVEL_EDITOR_MODEL", "gpt-4o-mini")
+# 分段设计大纲时每段的章节数，每段完成后其章节即可开始创作
+OUTLINE_CHUNK = max(1, int(os.getenv("NOVEL_OUTLINE_CHUNK", "10")))
+# 章节初稿并发创作的最大请求数，避免触发接口限流
+MAX_CONCURRENCY = int(os.getenv("NOVEL_MAX_CONCURRENCY", "10"))
+# 批量模式：初稿与润色通过OpenAI Batch API离线完成，成本减半但可能需要数小时
+BATCH_MODE = os.getenv("NOVEL_BATCH_MODE", "0") == "1"
+# 合并模式：创作、审查、润色合并为每章一次调用，直接输出润色后的正文，减少网络往返；
+# 未开启批量模式时默认使用，设置为0（或开启批量模式）时使用创作、审查、润色分开调用的流程
+FUSED_CHAPTER = os.getenv("NOVEL_FUSED_CHAPTER", "0" if BATCH_MODE else "1") == "1"
+if BATCH_MODE and FUSED_CHAPTER:
+    logging.warning("NOVEL_BATCH_MODE只适用于分开调用的流程，NOVEL_FUSED_CHAPTER=1时不生效，章节将通过实时接口创作")
+# 章节篇幅范围：合并模式下低于下限时重新创作一次；分开调用的流程中篇幅在范围内的章节可以跳过审查
+MIN_CHAPTER_WORDS = int(os.getenv("NOVEL_MIN_CHAPTER_WORDS", "2000"))
+MAX_CHAPTER_WORDS = int(os.getenv("NOVEL_MAX_CHAPTER_WORDS", "3000"))
+# 记录每次调用的完整输入输出trace，主流程不读取trace，默认关闭以节省内存和序列化开销
+TRACE = os.getenv("NOVEL_TRACE", "0") == "1"
+# Web服务端口：指定NOVEL_PORT时直接使用该端口，否则在默认范围内查找可用端口
+WEB_PORT = range(23467, 24000)
+_port_env = os.getenv("NOVEL_PORT", "").strip()
+if _port_env:
+    if _port_env.isdigit() and 0 < int(_port_env) < 65536:
+        WEB_PORT = int(_port_env)
+    else:
+        logging.error(f"NOVEL_PORT={_port_env!r} 不是有效的端口号，改为在23467-23999范围内查找可用端口")
+
+# 章节创作与润色共用的线程池，同时也限制了进程内并发的请求数；
+# 使用lazyllm的线程池，子线程继承提交者的会话，流式输出和trace能回到对应的Web会话
+_agent_executor = lazyllm.ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+# 后台生成章节摘要使用单独的小线程池，不必排在大批初稿请求之后
+_chapter_executor = lazyllm.ThreadPoolExecutor(max_workers=2)
+
+# 审查时前文上下文的token预算，以及生成章节摘要使用的低成本模型
+CONTEXT_MAX_TOKENS = int(os.getenv("NOVEL_CONTEXT_TOKENS", "4000"))
+# 前文中保留原文的最近章节数，更早的章节只以摘要进入上下文；
+# 保留上一章原文用于检查衔接，也不必等待其摘要生成完成
+CONTEXT_RECENT = int(os.getenv("NOVEL_CONTEXT_RECENT", "1"))
+SUMMARY_MODEL = os.getenv("NOVEL_SUMMARY_MODEL", "gpt-4o-mini")
+
+# 各Agent模块和创作流程在进程内只创建一次，重复调用直接返回同一个流程；
+# 模型、并发等配置在模块导入时读取，进程运行期间保持不变
+@functools.lru_cache(maxsize=1)
 def create_novel_pipeline():
-    # 环境配置
-base_url = os.getenv("LAZYLLM_BASE_URL", "https://www.dmxapi.com/v1/")
-    api_key = os.getenv("LAZYLLM_OPENAI_API_KEY", "")
-    
-    if not api_key:
+    # 缺少密钥时在创建流程时报错，而不是在导入模块时
+    if not API_KEY:
         raise ValueError("请设置LAZYLLM_OPENAI_API_KEY环境变量")
     
     # 创建各个Agent
-    story_planner = lazyllm.OnlineChatModule(
-        source="openai", model="gpt-4", base_url=base_url,
-        api_key=api_key, stream=False, return_trace=True
-    ).formatter(JsonFormatter()).prompt(story_planning_prompt)
-    
-    outline_designer = lazyllm.OnlineChatModule(
-        source="openai", model="gpt-4", base_url=base_url,
-        api_key=api_key, stream=False, return_trace=True
-    ).formatter(JsonFormatter()).prompt(outline_design_prompt)
-    
-    content_writer = lazyllm.OnlineChatModule(
-        source="openai", model="gpt-4", base_url=base_url,
-        api_key=api_key, stream=False, return_trace=True
-    ).prompt(content_writing_prompt)
-    
-    quality_reviewer = lazyllm.OnlineChatModule(
-        source="openai", model="gpt-4", base_url=base_url,
-        api_key=api_key, stream=False, return_trace=True
-    ).formatter(JsonFormatter()).prompt(quality_review_prompt)
-    
-    editor = lazyllm.OnlineChatModule(
-        source="openai", model="gpt-4", base_url=base_url,
-        api_key=api_key, stream=False, return_trace=True
-    ).prompt(editing_prompt)
+    # 同一模型的Agent共用一个在线模型模块，通过share绑定各自的prompt和formatter，
+    # 避免每个Agent各自建立一套客户端；模型、流式等配置也只需在这里统一调整
+    base_modules = {}
+    # 各JSON输出的Agent共用一个formatter实例
+    json_formatter = JsonFormatter()
+
+    def make_agent(prompt, *, model=MODEL, json_out=False):
+        if model not in base_modules:
+            base_modules[model] = lazyllm.OnlineChatModule(
+                source="openai", model=model, base_url=BASE_URL,
+                api_key=API_KEY, stream=False, return_trace=TRACE
+            )
+        return base_modules[model].share(
+            prompt=prompt, format=json_formatter if json_out else None
+        )
+
+    story_planner = make_agent(story_planning_prompt, json_out=True)
+    outline_designer = make_agent(outline_design_prompt, json_out=True)
+    content_writer = make_agent(content_writing_prompt)
+    quality_reviewer = make_agent(quality_review_prompt, model=REVIEW_MODEL, json_out=True)
+    # 润色与初稿一样在多章之间并发进行，流式输出会相互穿插，因此保持非流式
+    editor = make_agent(editing_prompt, model=EDITOR_MODEL)
+    chapter_author = make_agent(fused_chapter_prompt)
+    # 章节摘要只用于上下文压缩，使用低成本模型
+    chapter_summarizer = make_agent(chapter_summary_prompt, model=SUMMARY_MODEL)
+
+    # 相同输入下规划、大纲的结果可以直接复用；润色的输入是每次都不同的初稿，缓存无法命中，不做缓存
+    # 缓存中只保存通过校验的结果，格式无效的回复不会在之后的运行中被重复使用
+    cached_planner = cached_agent(story_planner, "planner", MODEL, story_planning_prompt, parse=parse_story_setting)
+    cached_outliner = cached_agent(outline_designer, "outliner", MODEL, outline_design_prompt, parse=parse_outline_chunk)
 
     # 使用 pipeline 串联各 Agent，便于可视化和管理
     with pipeline() as novel_creator:
@@ -368,101 +930,334 @@ base_url = os.getenv("LAZYLLM_BASE_URL", "https://www.dmxapi.com/v1/")
     # 小说创作主流程
     def novel_creation_workflow(user_input):
         context = NovelContext()
+        context_budget = ContextBudget(max_tokens=CONTEXT_MAX_TOKENS, keep_recent=CONTEXT_RECENT)
         log_progress("系统初始化", "Multi-Agent小说创作系统启动")
+        if FUSED_CHAPTER:
+            log_progress("系统初始化", "合并模式：每章一次调用完成创作与润色，不进行单独审查、前文摘要和上下文预算")
+        else:
+            log_progress("系统初始化", f"分开调用模式：创作、审查、润色分别调用{'，初稿与润色通过Batch API提交' if BATCH_MODE else ''}")
         
         # 阶段1：故事规划
         log_progress("故事策划", "开始分析用户输入并制定故事设定")
-        story_setting = story_planner(user_input)
+        story_setting = call_agent(cached_planner, user_input)
+        if story_setting is None:
+            logging.warning("故事设定格式无效，使用默认设定")
+            story_setting = {}
         context.update_setting(story_setting)
-        log_progress("故事策划", f"完成故事设定：{story_setting.get('story_theme', '未知主题')}")
+        story_theme = story_setting.get('story_theme', '未知主题')
+        log_progress("故事策划", f"完成故事设定：{story_theme}")
+        # 章节边创作边写入本地cache目录，不在内存中保留整本小说
+        cache_file = create_novel_cache(story_theme)
         
-        # 阶段2：大纲设计
-        log_progress("大纲设计", "开始设计详细章节大纲")
-        setting_text = json.dumps(story_setting, ensure_ascii=False)
-        outline = outline_designer(setting_text)
+        # 阶段2、3：分段设计大纲，每段大纲完成后其章节立即开始并行创作，不必等待整份大纲
+        # 初稿只依赖大纲：提供已设计章节的目录，再附上上一章的大纲概要作为前情提要，
+        # 各章之间没有依赖，可以并发提交
+        setting_text = context.story_setting_json
+        chapter_setting_text = context.chapter_setting_json
+        total_chapters = target_chapter_count(story_setting)
+        outline = []
+        # 各章大纲在创作过程中不再变化，只序列化一次供所有章节复用
+        outline_jsons = []
+
+        def build_writing_prompt(i, outline_digest):
+            if i > 0:
+                prev_outline = outline[i - 1]
+                prior_text = f"上一章《{prev_outline.get('title', '')}》：{prev_outline.get('summary', '')}"
+            else:
+                prior_text = "这是第一章"
+            return writing_template.format(
+                setting=chapter_setting_text, digest=outline_digest, outline=outline_jsons[i],
+                characters=context.characters_json_for(outline_jsons[i]), prior=prior_text
+            )
+
+        def write_draft(i, outline_digest):
+            """创作第i章，返回(初稿, 润色稿)，尚未润色时润色稿为None"""
+            log_progress("内容创作", f"开始创作第{i+1}章：{outline[i].get('title', '')}")
+            writing_prompt = build_writing_prompt(i, outline_digest)
+            if FUSED_CHAPTER:
+                chapter_content = call_agent(chapter_author, writing_prompt)
+                word_count = check_word_count(chapter_content)
+                if word_count < MIN_CHAPTER_WORDS:
+                    log_progress("内容创作", f"第{i+1}章篇幅不足{MIN_CHAPTER_WORDS}字，重新创作")
+                    expanded = call_agent(chapter_author, expand_template.format(
+                        prompt=writing_prompt, min_words=MIN_CHAPTER_WORDS
+                    ))
+                    # 重新创作的版本反而更短时保留第一次的结果
+                    expanded_count = check_word_count(expanded)
+                    if expanded_count > word_count:
+                        chapter_content, word_count = expanded, expanded_count
+                log_progress("内容创作", f"第{i+1}章完成创作与润色，字数：{word_count}")
+                return chapter_content, chapter_content
+            chapter_content = call_agent(content_writer, writing_prompt)
+            log_progress("内容创作", f"第{i+1}章完成初稿，字数：{check_word_count(chapter_content)}")
+            return chapter_content, None
+
+        # 已达到字数目标时置位，尚在进行中的章节不再继续润色
+        stop_drafting = threading.Event()
+
+        def draft_and_polish(i, outline_digest):
+            # 流水线：初稿完成后立即在同一任务中润色，不必等待前面章节审查完成
+            chapter_content, polished_content = write_draft(i, outline_digest)
+            if polished_content is None and not stop_drafting.is_set():
+                log_progress("编辑润色", f"开始润色第{i+1}章")
+                polished_content = call_agent(editor, chapter_content)
+            return chapter_content, polished_content
+
+        def fold_summary(previous_summary, chapter_content):
+            # 线程池按提交顺序执行，上一章的摘要任务总是先开始，等待它不会死锁
+            summary = previous_summary.result() if previous_summary else "无，这是第一章"
+            try:
+                return call_agent(chapter_summarizer, rolling_summary_template.format(
+                    summary=summary, chapter=chapter_content
+                ))
+            except Exception as e:
+                # 摘要只用于压缩上下文，失败时沿用上一章的摘要，不中断后续章节的审查
+                logging.warning(f"前文摘要生成失败，沿用之前的摘要: {e}")
+                return summary if previous_summary else "无"
+
+        def outline_digest_so_far():
+            return to_json([o.get('title', f'第{j+1}章') for j, o in enumerate(outline)])
+
+        # 批量模式需要拿到全部大纲后一次性提交，其余情况每段大纲完成即开始创作
+        batch_drafting = BATCH_MODE and not FUSED_CHAPTER
+        draft_futures = []
+        # 按大纲中各章的目标字数累加，预计达到目标字数后的章节先不提交，实际字数不足时再补交
+        planned_words = 0
+        planned_stop = None
+        log_progress("大纲设计", f"开始设计详细章节大纲，共{total_chapters}章，每段{OUTLINE_CHUNK}章")
+        chunk_ranges = [
+            (start, min(start + OUTLINE_CHUNK - 1, total_chapters))
+            for start in range(1, total_chapters + 1, OUTLINE_CHUNK)
+        ]
+
+        def design_outline_chunk(start, end, prior_outline):
+            expected = end - start + 1
+            prompt = outline_request_template.format(
+                setting=setting_text, total=total_chapters, start=start, end=end, prior=prior_outline
+            )
+            # 章节数不对的结果不写入缓存，重试时会重新请求模型
+            check = lambda chunk: len(chunk) == expected
+            chunk = call_agent(cached_outliner, prompt, check)
+            if len(chunk) != expected:
+                logging.warning(f"第{start}-{end}章大纲返回{len(chunk)}章，应为{expected}章，重新设计")
+                chunk = call_agent(cached_outliner, prompt, check)
+            if len(chunk) != expected:
+                # 重试后仍不对时保留已有的章节，之后各章的位置会与chapter_number错开
+                logging.warning(f"第{start}-{end}章大纲重新设计后仍为{len(chunk)}章，应为{expected}章")
+            return chunk[:expected]
+
+        # 第一段单独设计；其余各段只参考第一段的概要，同时并行设计。
+        # 在提交第一段的初稿之前提交，避免排在大批初稿请求之后
+        first_chunk = design_outline_chunk(*chunk_ranges[0], "无，从第一章开始")
+        if not first_chunk:
+            raise RuntimeError("第一段章节大纲为空，无法继续创作")
+        first_brief = to_json([
+            {'chapter_number': j + 1, 'title': o.get('title', ''), 'summary': o.get('summary', '')}
+            for j, o in enumerate(first_chunk)
+        ])
+        outline_futures = [
+            _agent_executor.submit(design_outline_chunk, start, end, first_brief) for start, end in chunk_ranges[1:]
+        ]
+        for n, (start, end) in enumerate(chunk_ranges):
+            chunk = first_chunk if n == 0 else outline_futures[n - 1].result()
+            chunk_start = len(outline)
+            outline.extend(chunk)
+            outline_jsons.extend(to_json(o) for o in chunk)
+            log_progress("大纲设计", f"完成第{start}-{end}章大纲，共{len(chunk)}章")
+            # 不等待全部章节：第i章一完成即可开始审查，其余章节继续在后台创作和润色；
+            # 批量模式只在这里预估章节数，拿到全部大纲后再一次性提交
+            digest = outline_digest_so_far()
+            for i in range(chunk_start, len(outline)):
+                if planned_stop is not None:
+                    break
+                if not batch_drafting:
+                    draft_futures.append(_agent_executor.submit(draft_and_polish, i, digest))
+                planned_words += chapter_target_words(outline[i])
+                if planned_words >= TARGET_WORDS:
+                    planned_stop = i + 1
+                    log_progress("大纲设计", f"预计前{planned_stop}章即可达到{TARGET_WORDS}字，后续章节暂不创作")
         context.update_outline(outline)
         log_progress("大纲设计", f"完成大纲设计，共{len(outline)}章")
         
-        # 阶段3：章节创作循环
-        final_novel = []
-        
-        for i, chapter_outline in enumerate(outline):
-            log_progress("内容创作", f"开始创作第{i+1}章：{chapter_outline.get('title', '')}")
-            
-            # 准备章节创作的上下文
-            chapter_context = context.get_context_for_chapter(i)
-            writing_prompt = f"""
-章节大纲：{json.dumps(chapter_outline, ensure_ascii=False)}
+        def stop_remaining_drafts():
+            # 尚在进行中的章节不再润色，尚未开始的初稿请求直接取消
+            stop_drafting.set()
+            for future in draft_futures:
+                future.cancel()
 
-故事背景：{json.dumps(chapter_context['story_setting'], ensure_ascii=False)}
+        def iter_drafts():
+            for i in range(len(outline)):
+                if i == len(draft_futures) or draft_futures[i].cancelled():
+                    # 已提交的章节实际字数不足目标（或预计达到目标时已被取消），
+                    # 与最初提交时一样按大纲目标字数估算缺口，只补交足够填补缺口的章节
+                    shortfall = TARGET_WORDS - context.total_words
+                    end, planned = i, 0
+                    while end < len(outline) and (end == i or planned < shortfall):
+                        planned += chapter_target_words(outline[end])
+                        end += 1
+                    log_progress("内容创作", f"字数尚未达到目标，继续创作第{i+1}-{end}章")
+                    stop_drafting.clear()
+                    digest = outline_digest_so_far()
+                    for j in range(i, end):
+                        # 仍在进行或已完成的章节保留原结果，只替换缺失和已取消的
+                        if j == len(draft_futures):
+                            draft_futures.append(_agent_executor.submit(draft_and_polish, j, digest))
+                        elif draft_futures[j].cancelled():
+                            draft_futures[j] = _agent_executor.submit(draft_and_polish, j, digest)
+                yield draft_futures[i].result()
 
-前文内容：
-{chr(10).join(chapter_context['recent_chapters'][-2:]) if chapter_context['recent_chapters'] else "这是第一章"}
+        def completed(result):
+            future = Future()
+            future.set_result(result)
+            return future
 
-请根据以上信息创作本章内容。
-"""
-            
-            # 内容创作
-            chapter_content = content_writer(writing_prompt)
-            word_count = check_word_count(chapter_content)
-            log_progress("内容创作", f"完成初稿，字数：{word_count}")
-            
-            # 质量审查
-            log_progress("质量审查", "开始质量检查")
-            review_prompt = f"""
-章节内容：
-{chapter_content}
+        if batch_drafting:
+            # 初稿与润色各作为一个Batch任务提交，不占用实时接口的限流额度；
+            # 只提交预计达到目标字数所需的章节，实际字数不足时由iter_drafts实时补交
+            batch_count = planned_stop or len(outline)
+            digest = outline_digest_so_far()
+            contents = None
+            try:
+                log_progress("内容创作", f"通过Batch API提交{batch_count}章初稿")
+                contents = run_chat_batch(
+                    BASE_URL, API_KEY, content_writing_prompt,
+                    [build_writing_prompt(i, digest) for i in range(batch_count)], model=MODEL
+                )
+                # Batch中失败的章节改为实时补写
+                missing = [i for i, content in enumerate(contents) if not content]
+                for i, (content, _) in zip(missing, _agent_executor.map(write_draft, missing, [digest] * len(missing))):
+                    contents[i] = content
+            except Exception as e:
+                logging.error(f"Batch API提交初稿失败，改为实时创作: {e}")
+                contents = None
+                log_progress("内容创作", f"并行创作{batch_count}章，并发数：{MAX_CONCURRENCY}")
+                draft_futures = [_agent_executor.submit(draft_and_polish, i, digest) for i in range(batch_count)]
+            if contents is not None:
+                # 润色批次单独处理：失败时保留已完成的初稿，在按顺序审查时实时润色
+                try:
+                    log_progress("编辑润色", f"通过Batch API提交{len(contents)}章润色")
+                    polished = run_chat_batch(BASE_URL, API_KEY, editing_prompt, contents, model=EDITOR_MODEL)
+                except Exception as e:
+                    logging.error(f"Batch API提交润色失败，改为审查时实时润色: {e}")
+                    polished = [None] * len(contents)
+                # 批量结果包装为已完成的任务，与实时创作共用按顺序审查和补交的流程
+                draft_futures = [completed(draft) for draft in zip(contents, polished)]
+        else:
+            log_progress("内容创作", f"并行创作{len(draft_futures)}章，并发数：{MAX_CONCURRENCY}")
+        drafts = iter_drafts()
 
-章节大纲：{json.dumps(chapter_outline, ensure_ascii=False)}
-故事设定：{json.dumps(chapter_context['story_setting'], ensure_ascii=False)}
-前文内容：{chr(10).join(chapter_context['recent_chapters'][-1:]) if chapter_context['recent_chapters'] else "无"}
-"""
-            review_result = quality_reviewer(review_prompt)
-            
-            # 根据审查结果决定是否需要修改
-            if review_result.get('approved', False):
-                final_content = review_result.get('revised_content', chapter_content)
-                if final_content.strip():  # 如果有修改内容，使用修改后的
-                    logging.info(f"质量审查: 使用修改后内容，原字数: {word_count}, 修改后字数: {check_word_count(final_content)}")
-                else:
-                    final_content = chapter_content  # 否则使用原内容
-                log_progress("质量审查", f"通过审查，质量评分：{review_result.get('quality_score', 'N/A')}")
+        # 阶段4：按顺序审查，审查时使用真实的前文内容保证连贯性；
+        # 与阶段3流水线衔接，后续章节仍在并行创作和润色
+        previous_approved = False
+
+        def reaches_target(i, text):
+            # 按本章将要保存的文本预估总字数，本章完成后即可达到目标时立即停止后续章节，不必等到本章保存
+            if context.total_words + check_word_count(text) < TARGET_WORDS:
+                return False
+            if not stop_drafting.is_set():
+                log_progress("目标达成", f"预计第{i+1}章完成后达到{TARGET_WORDS}字，停止创作后续章节")
+                stop_remaining_drafts()
+            return True
+
+        for i, (chapter_outline, (chapter_content, pre_polished)) in enumerate(zip(outline, drafts)):
+            if FUSED_CHAPTER:
+                # 合并模式下创作、审查、润色已在同一次调用中完成，稿件即为最终文本
+                final_content, polished_content = chapter_content, pre_polished
+                original_word_count = check_word_count(final_content)
+                reaches_target(i, final_content)
             else:
-                final_content = chapter_content
-                log_progress("质量审查", "需要改进，但继续进行")
-            
-            # 编辑润色
-            log_progress("编辑润色", "开始最终润色")
-            polished_content = editor(final_content)
-            
-            # 验证润色后内容长度
+                word_count = check_word_count(chapter_content)
+                high_quality = False
+
+                if previous_approved and MIN_CHAPTER_WORDS <= word_count <= MAX_CHAPTER_WORDS:
+                    # 篇幅合格且上一章审查通过时跳过本章审查，相邻两章中至少审查一章
+                    final_content = chapter_content
+                    original_word_count = word_count
+                    previous_approved = False
+                    log_progress("质量审查", f"篇幅合格且上一章审查通过，跳过第{i+1}章审查")
+                else:
+                    # 质量审查
+                    log_progress("质量审查", "开始质量检查")
+                    chapter_context = context.get_context_for_chapter(i)
+                    previous_text = context_budget.build(
+                        chapter_context['recent_chapters'],
+                        chapter_context['recent_chapter_tokens'],
+                        chapter_context['story_summaries'],
+                    )
+                    review_prompt = review_template.format(
+                        setting=chapter_context['chapter_setting_json'], outline=outline_jsons[i],
+                        characters=context.characters_json_for(outline_jsons[i]),
+                        previous=previous_text, content=chapter_content
+                    )
+                    review_result = parse_review(call_agent(quality_reviewer, review_prompt))
+                    previous_approved = review_result['approved']
+
+                    # 根据审查结果决定是否需要修改
+                    if previous_approved:
+                        high_quality = review_result['quality_score'] >= 8
+                        final_content = review_result['revised_content']
+                        if final_content.strip():  # 如果有修改内容，使用修改后的
+                            original_word_count = check_word_count(final_content)
+                            logging.info(f"质量审查: 使用修改后内容，原字数: {word_count}, 修改后字数: {original_word_count}")
+                        else:
+                            final_content = chapter_content  # 否则使用原内容
+                            original_word_count = word_count
+                        log_progress("质量审查", f"通过审查，质量评分：{review_result['quality_score']:g}")
+                    else:
+                        final_content = chapter_content
+                        original_word_count = word_count
+                        log_progress("质量审查", "需要改进，但继续进行")
+
+                # 编辑润色：初稿已在流水线中润色过，只有审查给出修改稿（或润色缺失）时才需要重新润色；
+                # 高分通过审查或已是最后一章时，直接使用修改稿；审查决定后按将要保存的文本预估是否为最后一章
+                if final_content == chapter_content and pre_polished:
+                    polished_content = pre_polished
+                    reaches_target(i, polished_content)
+                elif reaches_target(i, final_content) or (high_quality and final_content != chapter_content):
+                    log_progress("编辑润色", "审查修改稿评分较高或已是最后一章，直接使用")
+                    polished_content = final_content
+                else:
+                    log_progress("编辑润色", "开始最终润色")
+                    polished_content = call_agent(editor, final_content)
+
+            # 验证润色后内容长度，各版本的字数只统计一次
             polished_word_count = check_word_count(polished_content)
-            original_word_count = check_word_count(final_content)
             
-            # 如果润色后内容明显变短，使用原内容
+            # 如果润色后内容明显变短，要求保持篇幅重新润色一次，仍然过短时使用原内容
+            if polished_word_count < original_word_count * 0.5:
+                logging.warning(f"编辑润色: 润色后内容过短({polished_word_count} vs {original_word_count})，重新润色")
+                polished_content = call_agent(editor, keep_length_template.format(content=final_content))
+                polished_word_count = check_word_count(polished_content)
             if polished_word_count < original_word_count * 0.5:
-                logging.warning(f"编辑润色: 润色后内容过短({polished_word_count} vs {original_word_count})，使用原内容")
+                logging.warning(f"编辑润色: 重新润色后仍然过短({polished_word_count} vs {original_word_count})，使用原内容")
                 polished_content = final_content
                 polished_word_count = original_word_count
             
             # 添加到上下文和最终小说
-            context.add_chapter(polished_content)
-            final_novel.append(f"# {chapter_outline.get('title', f'第{i+1}章')}\n\n{polished_content}")
+            context.add_chapter(polished_content, polished_word_count)
+            if not FUSED_CHAPTER and context.total_words < TARGET_WORDS and i + 1 < len(outline):
+                # 摘要在后台依次滚动生成，等该章滑出原文窗口时早已完成；
+                # 已是最后一章时不再有后续章节使用摘要，不必生成
+                previous_summary = context.story_summaries[-1] if context.story_summaries else None
+                context.story_summaries.append(
+                    _chapter_executor.submit(fold_summary, previous_summary, polished_content)
+                )
+            cache_file = append_novel_cache(
+                cache_file, f"# {chapter_outline.get('title', f'第{i+1}章')}\n\n{polished_content}\n\n"
+            )
             
             log_progress("章节完成", f"第{i+1}章完成，润色后字数：{polished_word_count}", context)
             
-            # 检查是否达到5万字目标
-            if context.total_words >= 50000:
-                log_progress("目标达成", f"已达到5万字目标，当前总字数：{context.total_words}")
+            # 检查是否达到目标字数
+            if context.total_words >= TARGET_WORDS:
+                log_progress("目标达成", f"已达到{TARGET_WORDS}字目标，当前总字数：{context.total_words}")
                 break
+
+        # 提前达到目标时，取消尚未开始的初稿请求
+        stop_remaining_drafts()
         
-        # 生成最终小说
-        complete_novel = "\n\n".join(final_novel)
         log_progress("创作完成", f"小说创作完成！总字数：{context.total_words}，共{context.current_chapter}章")
-        
-        # 保存到本地cache目录
-        story_theme = context.story_setting.get('story_theme', '未知主题')
-        cache_file = save_novel_to_cache(complete_novel, story_theme, context.total_words, context.current_chapter)
+        cache_file = finish_novel_cache(cache_file, context.total_words, context.current_chapter)
         
         # 准备返回结果
         result = {
@@ -472,10 +1267,11 @@ base_url = os.getenv("LAZYLLM_BASE_URL", "https://www.dmxapi.com/v1/")
                 "log": "",
                 "files": []
             },
-            "novel": complete_novel,
+            "novel_file": cache_file,
             "statistics": {
                 "total_words": context.total_words,
                 "total_chapters": context.current_chapter,
+                "total_tokens": context.total_tokens,
                 "story_theme": story_theme,
                 "genre": context.story_setting.get('genre', ''),
                 "cache_file": cache_file
@@ -495,12 +1291,12 @@ if __name__ == '__main__':
         # 创建小说创作流程
         novel_workflow = create_novel_pipeline()
 
-        logging.info("Web 服务启动，端口范围 23467-23999")
+        logging.info(f"Web 服务启动，端口: {WEB_PORT if isinstance(WEB_PORT, int) else '23467-23999'}")
 
         # 使用WebModule提供Web界面
         lazyllm.WebModule(
             novel_workflow,
-            port=range(23467, 24000),
+            port=WEB_PORT,
             title="Multi-Agent小说创作系统",
             history=[]
         ).start().wait()